@@ -33,9 +33,14 @@ Given a directory with all these files, this script will:
 
  - Track data (album name and spotify URI) are added in a few ways:
     - Search for the song and artist in endsong. If a match is exact, copy.
-    - For songs that weren't found, use Selenium to scrape the Spotify search.
+    - For songs that weren't found, search the Spotify Web API if client
+        credentials are given. If the title and artist of the first result
+        match, use the album name and Spotify URI from that entry.
+    - For songs that are still missing, use Selenium to scrape the Spotify search.
         - If the title and artist of the first result match, use the album name
-            and Spotify URI from that entry.
+            and Spotify URI from that entry. These are looked up by a few
+            headless browsers in parallel.
+        - Every song is only looked up once, results are stored in data.db.
         - If these don't match, the user is prompted for action:
             - The user can signal no song matches
             - The user can signal another search result index to use other
@@ -46,11 +51,21 @@ Given a directory with all these files, this script will:
  - Finally all modified data is exported as a .json that can be imported.
 """
 
+import os
 import sqlite3
+from array import array
 import argparse
 import json
 import itertools
+import operator
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import ijson
+import orjson
+import requests
 from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.remote.webelement import WebElement
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
@@ -59,141 +74,351 @@ from selenium.webdriver.support import expected_conditions
 from tqdm import tqdm
 from pathlib import Path
 
-parser = argparse.ArgumentParser(description="Merge StreamingHistory.json and endsong.json files into endsong-style files")
-parser.add_argument("indir", help="input directory, output is in a subdirectory")
+# Files larger than this are streamed instead of parsed in one go
+STREAM_THRESHOLD = 64 * 1024 * 1024
+# Number of rows inserted at once
+CHUNK_SIZE = 10000
+# Seconds to wait for a Web API response
+API_TIMEOUT = 10
+# Number of browsers looking up songs at the same time
+SCRAPE_WORKERS = 4
+# First track in the Spotify search results
+RESULT_XPATH = "//*[@id=\"searchPage\"]/div/div/div/div[1]/div[2]/div[2]/div[1]/div"
+
+def record_rows(records: list[dict], fields: tuple[str], source: str, start: int = 0) -> list[tuple]:
+    """
+    Turn records from a StreamingHistory*.json or endsong_*.json file into rows
+    of the given fields (missing ones are None), followed by the file name and
+    the index of the record in the file.
+    """
+    get_fields = operator.itemgetter(*fields)
+    try:
+        return [ (*get_fields(obj), source, start + j) for j, obj in enumerate(records) ]
+    except KeyError:
+        # Not every record has every field
+        return [ (*[ obj.get(name) for name in fields ], source, start + j) for j, obj in enumerate(records) ]
+
+def read_rows(path: Path, fields: tuple[str]) -> list[tuple]:
+    """
+    Read an entire file in one go, see record_rows
+    """
+    return record_rows(orjson.loads(path.read_bytes()), fields, path.name)
+
+def normalize(name: str) -> str:
+    """
+    Normalize a track or artist name, so spelling variants compare equal
+    """
+    return name.strip().casefold()
+
+def store_matches(db: sqlite3.Connection, matches: dict[tuple[str, str], tuple[str, str]]) -> None:
+    """
+    Add looked up songs to scrape_cache and commit right away, so they are kept
+    even if the run is aborted later on
+    """
+    db.executemany("INSERT OR IGNORE INTO scrape_cache VALUES (?, ?, ?, ?)", [ (*key, *value) for key, value in matches.items() ])
+    db.commit()
+
+def authorize(session: requests.Session, client_id: str, client_secret: str) -> None:
+    """
+    Get a Web API token with the client credentials flow and use it for all
+    further requests in the session
+    """
+    res = session.post("https://accounts.spotify.com/api/token", data={ "grant_type": "client_credentials" }, auth=(client_id, client_secret), timeout=API_TIMEOUT)
+    res.raise_for_status()
+    session.headers["Authorization"] = f"Bearer {res.json()['access_token']}"
+
+def search_clear_matches(keys: list[tuple[str, str]], client_id: str, client_secret: str) -> list[tuple[str, str, str, str]]:
+    """
+    Search the Spotify Web API for each (track name, artist name), returns
+    (track name, artist name, album name, track ID) for every song where the
+    first result is an exact match. Songs that fail to be searched are left to
+    the browser lookups.
+    """
+    session = requests.Session()
+    try:
+        authorize(session, client_id, client_secret)
+    except requests.RequestException as e:
+        print(f"Could not use the Web API: {e}")
+        return []
+
+    found = []
+    for track_name, artist_name in tqdm(keys):
+        params = { "q": f"{track_name} {artist_name}", "type": "track", "limit": 1 }
+        try:
+            res = session.get("https://api.spotify.com/v1/search", params=params, timeout=API_TIMEOUT)
+            refreshed = False
+            while res.status_code == 429 or (res.status_code == 401 and not refreshed):
+                if res.status_code == 429:
+                    # Rate limited
+                    time.sleep(int(res.headers.get("Retry-After", 1)))
+                else:
+                    # The token expires after an hour
+                    authorize(session, client_id, client_secret)
+                    refreshed = True
+
+                res = session.get("https://api.spotify.com/v1/search", params=params, timeout=API_TIMEOUT)
+
+            res.raise_for_status()
+            items = res.json()["tracks"]["items"]
+        except requests.RequestException:
+            continue
+
+        if len(items) == 0:
+            continue
+
+        track = items[0]
+        if normalize(track["name"]) == normalize(track_name) and normalize(track["artists"][0]["name"]) == normalize(artist_name):
+            found.append((track_name, artist_name, track["album"]["name"], track["id"]))
+
+    return found
+
+def scrape_clear_matches(keys: list[tuple[str, str]], progress: tqdm) -> list[tuple[str, str, str, str]]:
+    """
+    Search Spotify for each (track name, artist name) in a headless browser,
+    returns (track name, artist name, album name, track ID) for every song where
+    the first result is an exact match. Everything else needs user input.
+    """
+    # Only the DOM is needed, don't bother rendering or loading images
+    options = webdriver.ChromeOptions()
+    options.add_argument("--headless=new")
+    options.add_argument("--disable-gpu")
+    options.add_argument("--blink-settings=imagesEnabled=false")
+    options.add_experimental_option("prefs", { "profile.managed_default_content_settings.images": 2 })
+    # Results are waited for explicitly
+    options.page_load_strategy = "eager"
+    try:
+        driver = webdriver.Chrome(options=options)
+    except WebDriverException:
+        # All of these are left to the manual lookup
+        progress.update(len(keys))
+        return []
+
+    found = []
+    try:
+        for track_name, artist_name in keys:
+            progress.update()
 
-args = parser.parse_args()
+            try:
+                driver.get(f"https://open.spotify.com/search/{track_name} - {artist_name}/tracks")
+                element: WebElement = WebDriverWait(driver, 10).until(expected_conditions.presence_of_element_located((By.XPATH, RESULT_XPATH)))
+                found_name = element.find_element(By.CSS_SELECTOR, "div:nth-child(2) > div > div").text
+                found_artist = element.find_element(By.CSS_SELECTOR, "div:nth-child(2) > div > span").text
+                if normalize(found_name) != normalize(track_name) or normalize(found_artist) != normalize(artist_name):
+                    continue
+
+                found_album = element.find_element(By.CSS_SELECTOR, "div:nth-child(3) > span > a").text
+                # The clipboard is shared between browsers, so take the link to the track instead
+                link = element.find_element(By.CSS_SELECTOR, "a[href*='/track/']").get_attribute("href")
+            except WebDriverException:
+                continue
 
-indir = Path(args.indir).resolve()
-outdir = indir / "fixed"
-outdir.mkdir(parents=True, exist_ok=True)
+            # Links can have a locale in front, e.g. /intl-de/track/<id>
+            if link is None or "/track/" not in link:
+                continue
 
-db_path = indir / "data.db"
-db_exists =  db_path.exists()
-db_source = sqlite3.connect(db_path)
-db = sqlite3.connect(":memory:")
-if db_exists:
-    db_source.backup(db)
-else:
-    # Create database
-    with db:
-        db.execute("""
-        CREATE TABLE history(
-            endTime TEXT,
-            artistName TEXT,
-            trackName TEXT,
-            msPlayed INTEGER,
-            source TEXT,
-            id INTEGER PRIMARY KEY
-        )
-        """)
+            found.append((track_name, artist_name, found_album, link.split("/track/", 1)[1].split("?")[0]))
+    finally:
+        driver.quit()
 
-        db.execute("""
-        CREATE TABLE endsong(
-            ts TEXT,
-            username TEXT,
-            platform TEXT,
-            ms_played INTEGER,
-            conn_country TEXT,
-            ip_addr_decrypted TEXT,
-            user_agent_decrypted TEXT,
-            master_metadata_track_name TEXT,
-            master_metadata_album_artist_name TEXT,
-            master_metadata_album_album_name TEXT,
-            spotify_track_uri TEXT,
-            episode_name TEXT,
-            episode_show_name TEXT,
-            spotify_episode_uri TEXT,
-            reason_start TEXT,
-            reason_end TEXT,
-            shuffle INTEGER,
-            skipped INTEGER,
-            offline INTEGER,
-            offline_timestamp INTEGER,
-            incognito_mode INTEGER,
-            source TEXT,
-            id INTEGER PRIMARY KEY
-        )
-        """)
+    return found
 
-    i = 0
-    for hist in itertools.chain(indir.glob("StreamingHistory*.json"), indir.glob("endsong_*.json")):
-        print(f"Reading {hist.relative_to(indir)}")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge StreamingHistory.json and endsong.json files into endsong-style files")
+    parser.add_argument("indir", help="input directory, output is in a subdirectory")
+    parser.add_argument("--client-id", default=os.environ.get("SPOTIFY_CLIENT_ID"), help="Spotify app client ID for the Web API, defaults to $SPOTIFY_CLIENT_ID")
+    parser.add_argument("--client-secret", default=os.environ.get("SPOTIFY_CLIENT_SECRET"), help="Spotify app client secret for the Web API, defaults to $SPOTIFY_CLIENT_SECRET")
 
-        table = "history" if hist.name.startswith("StreamingHistory") else "endsong"
+    args = parser.parse_args()
 
-        with db:
-            obj: dict
-            for obj in json.load(hist.open("r", encoding="utf-8")):
-                obj["source"] = hist.name
-                obj["id"] = i
-                i += 1
-                keys_str = ",".join([ f":{name}" for name in obj.keys() ])
-                db.execute(f"INSERT INTO {table} VALUES ({keys_str})", obj)
-
-    with db:
-        db.execute("CREATE TABLE endsong_modified AS SELECT * FROM endsong WHERE 1 = 2")
-
-i = 0
-
-with db:
-    # Entries with multiple or no matches, to be re-inspected
-    multiple: set[tuple[int]] = set()
-    none: set[int] = set()
-    # All entries with issues
-    row: tuple[str]
-    print("Initial pass")
-    count = db.execute("SELECT COUNT(*) FROM endsong WHERE platform = 'ios'").fetchone()[0]
-    for row in tqdm(db.execute("SELECT * FROM endsong WHERE platform = 'ios'"), total=count):
-        ts: str = row[0][:16].replace("T", " ", 1)
-        matches = db.execute("SELECT * FROM history WHERE endTime = ? AND msPlayed = ?", (ts, row[3])).fetchall()
-        if len(matches) == 1:
-            # Check if row was already updated
-            count = db.execute("SELECT COUNT(id) FROM endsong_modified WHERE id = ?", (row[-1],)).fetchone()[0]
-            if count == 0:
-                db.execute("INSERT INTO endsong_modified SELECT * FROM endsong WHERE id = ?", (row[-1],))
-                db.execute("UPDATE endsong_modified SET master_metadata_track_name = ?, master_metadata_album_artist_name = ? WHERE id = ?", (matches[0][2], matches[0][1], row[-1]))
-                i += 1
+    indir = Path(args.indir).resolve()
+    outdir = indir / "fixed"
+    outdir.mkdir(parents=True, exist_ok=True)
 
-        elif len(matches) > 1:
-            match_ids = [
-                v[-1] for v in matches
-            ]
-            match_ids.sort()
+    db_path = indir / "data.db"
+    db = sqlite3.connect(db_path, isolation_level="IMMEDIATE", cached_statements=1024)
 
-            multiple.add(tuple(match_ids))
-        else:
-            none.add(row[-1])
+    # data.db is just a cache of the input files, so trade all durability for speed.
+    # The journal is only kept in memory, so a failed run can still roll back.
+    db.execute("PRAGMA journal_mode = MEMORY")
+    db.execute("PRAGMA synchronous = OFF")
+    db.execute("PRAGMA temp_store = MEMORY")
+    db.execute("PRAGMA cache_size = -262144")
+    db.execute("PRAGMA locking_mode = EXCLUSIVE")
 
-    print("Fix entries with multiple matches")
-    for entry in tqdm(multiple):
-        entry_str = ','.join(map(str, entry))
-        history = db.execute(f"SELECT * FROM history WHERE id IN ({entry_str})").fetchall()
+    # endsong_modified is created last, so the input files were read if it exists
+    db_exists = db.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'endsong_modified'").fetchone()[0] > 0
+    if not db_exists:
+        # Create database, in a single transaction so an interrupted run leaves nothing behind
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("""
+            CREATE TABLE history(
+                endTime TEXT,
+                artistName TEXT,
+                trackName TEXT,
+                msPlayed INTEGER,
+                source TEXT,
+                id INTEGER PRIMARY KEY
+            ) STRICT
+            """)
+
+            db.execute("""
+            CREATE TABLE endsong(
+                ts TEXT,
+                username TEXT,
+                platform TEXT,
+                ms_played INTEGER,
+                conn_country TEXT,
+                ip_addr_decrypted TEXT,
+                user_agent_decrypted TEXT,
+                master_metadata_track_name TEXT,
+                master_metadata_album_artist_name TEXT,
+                master_metadata_album_album_name TEXT,
+                spotify_track_uri TEXT,
+                episode_name TEXT,
+                episode_show_name TEXT,
+                spotify_episode_uri TEXT,
+                reason_start TEXT,
+                reason_end TEXT,
+                shuffle INTEGER,
+                skipped INTEGER,
+                offline INTEGER,
+                offline_timestamp INTEGER,
+                incognito_mode INTEGER,
+                source TEXT,
+                id INTEGER PRIMARY KEY
+            ) STRICT
+            """)
+
+            # Column order as in the schema, the last 2 (source and id) are filled in by us
+            columns: dict[str, tuple[str]] = {
+                table: tuple(row[1] for row in db.execute(f"PRAGMA table_info({table})"))
+                for table in ("history", "endsong")
+            }
+
+            files = list(itertools.chain(indir.glob("StreamingHistory*.json"), indir.glob("endsong_*.json")))
+            tables = { hist: "history" if hist.name.startswith("StreamingHistory") else "endsong" for hist in files }
+
+            # Smaller files are parsed in parallel, larger ones are streamed in here
+            small = (hist for hist in files if hist.stat().st_size <= STREAM_THRESHOLD)
+            workers = os.cpu_count() or 1
+
+            i = 0
+            with ProcessPoolExecutor(workers) as executor:
+                parsed = {}
+                for hist in files:
+                    # Besides the file being read, only one file per worker is parsed ahead,
+                    # so the parsed rows of all files never have to be in memory at once
+                    while len(parsed) <= workers and (ahead := next(small, None)) is not None:
+                        parsed[ahead] = executor.submit(read_rows, ahead, columns[tables[ahead]][:-2])
+
+                    print(f"Reading {hist.relative_to(indir)}")
+
+                    table = tables[hist]
+                    fields = columns[table][:-2]
+                    cols_str = ",".join(columns[table])
+                    qmarks = ",".join([ "?" for _ in fields ])
+                    # Rows are numbered within their file, IDs continue from the previous file
+                    insert = f"INSERT INTO {table} ({cols_str}) VALUES ({qmarks}, ?, ? + {i})"
+
+                    if hist in parsed:
+                        rows = parsed.pop(hist).result()
+                        db.executemany(insert, rows)
+                        i += len(rows)
+                    else:
+                        with hist.open("rb") as f:
+                            records = ijson.items(f, "item", use_float=True)
+                            count = 0
+                            while chunk := list(itertools.islice(records, CHUNK_SIZE)):
+                                db.executemany(insert, record_rows(chunk, fields, hist.name, count))
+                                count += len(chunk)
+
+                        i += count
+
+            db.execute("CREATE TABLE endsong_modified AS SELECT * FROM endsong WHERE 1 = 2")
 
-        ts_like = history[0][0].replace(" ", "T") + "%"
-        endsong = db.execute(f"SELECT id FROM endsong WHERE platform = 'ios' AND ms_played = {history[0][3]} AND ts LIKE '{ts_like}' ORDER BY offline_timestamp").fetchall()
+    i = 0
 
-        for hist_ent, endsong_id in zip(history, endsong):
-            endsong_id = endsong_id[0]
+    with db:
+        db.execute("CREATE INDEX IF NOT EXISTS idx_hist_end_ms ON history(endTime, msPlayed)")
+        # The ios plays by their end time in the history format, in the order they're paired up in
+        db.execute("CREATE INDEX IF NOT EXISTS idx_es_tsmin_ms ON endsong(replace(substr(ts, 1, 16), 'T', ' '), ms_played, offline_timestamp, id) WHERE platform = 'ios'")
+        # Every entry is only ever updated once
+        db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_es_modified_id ON endsong_modified(id)")
+
+        print("Initial pass")
+        # Names found per entry, keyed so the update below can look them up
+        db.execute("CREATE TEMP TABLE matched(id INTEGER PRIMARY KEY, trackName TEXT, artistName TEXT)")
+        # Entries with exactly 1 match can be copied over directly
+        db.execute("""
+        INSERT INTO matched
+        SELECT e.id, h.trackName, h.artistName
+        FROM endsong e
+        JOIN history h ON h.endTime = replace(substr(e.ts, 1, 16), 'T', ' ') AND h.msPlayed = e.ms_played
+        WHERE e.platform = 'ios' AND e.id NOT IN (SELECT id FROM endsong_modified)
+        GROUP BY e.id
+        HAVING COUNT(*) = 1
+        """)
 
-            # Copy row and update values
-            count = db.execute("SELECT COUNT(id) FROM endsong_modified WHERE id = ?", (endsong_id,)).fetchone()[0]
-            if count == 0:
-                db.execute("INSERT INTO endsong_modified SELECT * FROM endsong WHERE id = ?", (endsong_id,))
-                db.execute("UPDATE endsong_modified SET master_metadata_track_name = ?, master_metadata_album_artist_name = ? WHERE id = ?", (hist_ent[2], hist_ent[1], endsong_id))
-                i += 1
+        print("Fix entries with multiple matches")
+        # Pair up plays with the same end time and duration in order, which is the
+        # sequential ID in history and the offline timestamp in endsong
+        db.execute("""
+        INSERT INTO matched
+        WITH h AS (
+            SELECT endTime, msPlayed, trackName, artistName,
+                ROW_NUMBER() OVER (PARTITION BY endTime, msPlayed ORDER BY id) AS seq,
+                COUNT(*) OVER (PARTITION BY endTime, msPlayed) AS matches
+            FROM history
+        ), e AS (
+            SELECT id, replace(substr(ts, 1, 16), 'T', ' ') AS endTime, ms_played,
+                ROW_NUMBER() OVER (PARTITION BY replace(substr(ts, 1, 16), 'T', ' '), ms_played ORDER BY offline_timestamp, id) AS seq
+            FROM endsong
+            WHERE platform = 'ios'
+        )
+        SELECT e.id, h.trackName, h.artistName
+        FROM e
+        JOIN h ON h.endTime = e.endTime AND h.msPlayed = e.ms_played AND h.seq = e.seq
+        WHERE h.matches > 1 AND e.id NOT IN (SELECT id FROM endsong_modified)
+        """)
 
-    missing = set()
-    unsure = set()
-    print("Fix entries with no matches")
-    for entry in tqdm(none):
-        count = db.execute("SELECT COUNT(id) FROM endsong_modified WHERE id = ?", (entry,)).fetchone()[0]
-        if count == 0:
-            ts, ms_played = db.execute("SELECT ts, ms_played FROM endsong WHERE id = ?", (entry,)).fetchone()
-            matches = db.execute("SELECT artistName, trackName FROM history WHERE msPlayed = ?", (ms_played,)).fetchall()
-            if len(matches) > 0:
-                if len(set(matches)) > 1:
-                    options = list(set(matches))
+        i += db.execute("INSERT INTO endsong_modified SELECT * FROM endsong WHERE id IN (SELECT id FROM matched)").rowcount
+        db.execute("""
+        UPDATE endsong_modified
+        SET (master_metadata_track_name, master_metadata_album_artist_name) = (
+            SELECT trackName, artistName FROM matched WHERE matched.id = endsong_modified.id
+        )
+        WHERE id IN (SELECT id FROM matched)
+        """)
+        db.execute("DROP TABLE matched")
+
+        # Entries without any match as (id, ts, ms_played), to be re-inspected in order
+        none: list[tuple[int, str, int]] = db.execute("""
+        SELECT e.id, e.ts, e.ms_played
+        FROM endsong e
+        WHERE e.platform = 'ios' AND e.id NOT IN (SELECT id FROM endsong_modified) AND NOT EXISTS (
+            SELECT 1 FROM history h WHERE h.endTime = replace(substr(e.ts, 1, 16), 'T', ' ') AND h.msPlayed = e.ms_played
+        )
+        ORDER BY e.id
+        """).fetchall()
+
+        # IDs of entries that couldn't be fixed
+        missing = array("q")
+        unsure = array("q")
+        print("Fix entries with no matches")
+        # Distinct songs in history by play duration, as (artist name, track name)
+        options_by_ms: dict[int, list[tuple[str, str]]] = {
+            ms_played: list(dict.fromkeys((artist_name, track_name) for _, artist_name, track_name in songs))
+            for ms_played, songs in itertools.groupby(db.execute("SELECT msPlayed, artistName, trackName FROM history ORDER BY msPlayed, id"), key=operator.itemgetter(0))
+        }
+
+        # Updates to apply afterwards, as (track name, artist name, id)
+        fixed: list[tuple[str, str, int]] = []
+        for entry, ts, ms_played in tqdm(none):
+            options = options_by_ms.get(ms_played, [])
+            if len(options) > 0:
+                match = options[0]
+                if len(options) > 1:
                     print(f"Unsure for entry at {ts}:")
                     for j in range(len(options)):
                         print(f"[{j}] {options[j][0]} - {options[j][1]}")
@@ -201,133 +426,201 @@ with db:
                     x = input("Index or u/U for unsure: ")
 
                     if x == "U" or x == "u":
-                        unsure.add(entry)
+                        unsure.append(entry)
                         continue
 
-                    matches[0] = options[int(x)]
+                    match = options[int(x)]
 
-                db.execute("INSERT INTO endsong_modified SELECT * FROM endsong WHERE id = ?", (entry,))
-                db.execute("UPDATE endsong_modified SET master_metadata_track_name = ?, master_metadata_album_artist_name = ? WHERE id = ?", (matches[0][1], matches[0][0], entry))
+                fixed.append((match[1], match[0], entry))
                 i += 1
             else:
-                missing.add(entry)
-
-    no_extra: dict[tuple[str, str], int] = dict()
-    print("Add track data if applicable")
-    count = db.execute("SELECT COUNT(*) FROM endsong_modified WHERE master_metadata_album_album_name IS NULL OR spotify_track_uri IS NULL").fetchone()[0]
-    for track_name, artist_name, idnum in tqdm(db.execute("SELECT master_metadata_track_name, master_metadata_album_artist_name, id FROM endsong_modified WHERE master_metadata_album_album_name IS NULL OR spotify_track_uri IS NULL"), total=count):
-        data = db.execute("SELECT DISTINCT master_metadata_album_album_name, spotify_track_uri FROM endsong WHERE master_metadata_track_name = ? AND master_metadata_album_artist_name = ? ORDER BY ts DESC LIMIT 1", (track_name, artist_name)).fetchall()
-        if len(data) == 0:
-            no_extra[(track_name, artist_name)] = idnum
-        else:
-            db.execute("UPDATE endsong_modified SET master_metadata_album_album_name = ?, spotify_track_uri = ? WHERE id = ?", (data[0][0], data[0][1], idnum))
-
-    del no_extra[("Unknown Track", "Unknown Artist")]
-    skipped: dict[tuple[str, str], int] = dict()
-    if len(no_extra) > 0:
-        print(f"Manual entry of final {len(no_extra)} entries")
-        j = 1
-        driver = webdriver.Chrome()
-        result_xpath = "//*[@id=\"searchPage\"]/div/div/div/div[1]/div[2]/div[2]/div[1]/div"
-        for k, v in no_extra.items():
-            print(f"{j} / {len(no_extra)} remaining: {k[0]} - {k[1]}")
-            driver.get(f"https://open.spotify.com/search/{k[0]} - {k[1]}/tracks")
-            
-            try:
-                element: WebElement = WebDriverWait(driver, 10).until(expected_conditions.presence_of_element_located((By.XPATH, result_xpath)))
-            except:
+                missing.append(entry)
+
+        db.executemany("INSERT OR IGNORE INTO endsong_modified SELECT * FROM endsong WHERE id = ?", [ (entry,) for _, _, entry in fixed ])
+        db.executemany("UPDATE endsong_modified SET master_metadata_track_name = ?, master_metadata_album_artist_name = ? WHERE id = ?", fixed)
+
+        print("Add track data if applicable")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_es_track_artist ON endsong(master_metadata_track_name, master_metadata_album_artist_name, ts DESC)")
+        # Copy from the most recent play of the same song that does have track data
+        db.execute("""
+        UPDATE endsong_modified
+        SET (master_metadata_album_album_name, spotify_track_uri) = (
+            SELECT e.master_metadata_album_album_name, e.spotify_track_uri
+            FROM endsong e
+            WHERE e.master_metadata_track_name = endsong_modified.master_metadata_track_name
+                AND e.master_metadata_album_artist_name = endsong_modified.master_metadata_album_artist_name
+                AND e.spotify_track_uri IS NOT NULL
+            ORDER BY e.ts DESC
+            LIMIT 1
+        )
+        WHERE (master_metadata_album_album_name IS NULL OR spotify_track_uri IS NULL) AND EXISTS (
+            SELECT 1
+            FROM endsong e
+            WHERE e.master_metadata_track_name = endsong_modified.master_metadata_track_name
+                AND e.master_metadata_album_artist_name = endsong_modified.master_metadata_album_artist_name
+                AND e.spotify_track_uri IS NOT NULL
+        )
+        """)
+
+        no_extra: dict[tuple[str, str], int] = {
+            (track_name, artist_name): idnum
+            for track_name, artist_name, idnum in db.execute("SELECT master_metadata_track_name, master_metadata_album_artist_name, id FROM endsong_modified WHERE master_metadata_album_album_name IS NULL OR spotify_track_uri IS NULL")
+        }
+
+        no_extra.pop(("Unknown Track", "Unknown Artist"), None)
+        skipped = array("q")
+
+        # Spelling variants of the same song are only looked up once
+        variants: defaultdict[tuple[str, str], list[tuple[str, str]]] = defaultdict(list)
+        for track_name, artist_name in no_extra:
+            variants[(normalize(track_name), normalize(artist_name))].append((track_name, artist_name))
+
+        # Album name and track ID of every song looked up so far, including earlier runs.
+        # Every lookup stage commits its results, which also keeps the work done above.
+        db.execute("CREATE TABLE IF NOT EXISTS scrape_cache(track_norm TEXT, artist_norm TEXT, album TEXT, uri TEXT, PRIMARY KEY(track_norm, artist_norm))")
+        scraped: dict[tuple[str, str], tuple[str, str]] = {
+            (track_norm, artist_norm): (album_name, spotify_uri)
+            for track_norm, artist_norm, album_name, spotify_uri in db.execute("SELECT track_norm, artist_norm, album, uri FROM scrape_cache")
+        }
+
+        keys = [ names[0] for key, names in variants.items() if key not in scraped ]
+        if len(keys) > 0 and args.client_id is not None and args.client_secret is not None:
+            print(f"Searching {len(keys)} entries")
+            found = {
+                (normalize(track_name), normalize(artist_name)): (album_name, spotify_uri)
+                for track_name, artist_name, album_name, spotify_uri in search_clear_matches(keys, args.client_id, args.client_secret)
+            }
+            store_matches(db, found)
+            scraped.update(found)
+
+        keys = [ names[0] for key, names in variants.items() if key not in scraped ]
+        if len(keys) > 0:
+            print(f"Looking up {len(keys)} entries")
+            # Don't start browsers that wouldn't have anything to look up
+            workers = min(SCRAPE_WORKERS, len(keys))
+            with tqdm(total=len(keys)) as progress, ThreadPoolExecutor(workers) as executor:
+                shards = executor.map(scrape_clear_matches, [ keys[n::workers] for n in range(workers) ], itertools.repeat(progress))
+                found = {
+                    (normalize(track_name), normalize(artist_name)): (album_name, spotify_uri)
+                    for track_name, artist_name, album_name, spotify_uri in itertools.chain.from_iterable(shards)
+                }
+
+            store_matches(db, found)
+            scraped.update(found)
+
+        remaining = [ key for key in variants if key not in scraped ]
+        if len(remaining) > 0:
+            print(f"Manual entry of final {len(remaining)} entries")
+            j = 1
+            driver = webdriver.Chrome()
+            for key in remaining:
+                k = variants[key][0]
+                print(f"{j} / {len(remaining)} remaining: {k[0]} - {k[1]}")
+                driver.get(f"https://open.spotify.com/search/{k[0]} - {k[1]}/tracks")
+
+                try:
+                    element: WebElement = WebDriverWait(driver, 10).until(expected_conditions.presence_of_element_located((By.XPATH, RESULT_XPATH)))
+                except:
+                    j += 1
+                    continue
+
+                found_name = element.find_element(By.CSS_SELECTOR, "div:nth-child(2) > div > div").text
+                found_artist = element.find_element(By.CSS_SELECTOR, "div:nth-child(2) > div > span").text
+                found_album = element.find_element(By.CSS_SELECTOR, "div:nth-child(3) > span > a").text
+
+                matches = found_name == k[0] and found_artist == k[1]
+
+                if not matches:
+                    print(f"Expected: {k[1]} - {k[0]}")
+                    print(f"Got:      {found_artist} - {found_name}")
+                    res = input("Correct? (y/n/index) ")
+
+                    if res == "y" or res == "Y":
+                        matches = True
+                    elif res != "n" and res != "N":
+                        index = int(res)
+                        element = driver.find_element(By.XPATH, f"//*[@id=\"searchPage\"]/div/div/div/div[1]/div[2]/div[2]/div[{index}]/div")
+                        found_name = element.find_element(By.CSS_SELECTOR, "div:nth-child(2) > div > div").text
+                        found_artist = element.find_element(By.CSS_SELECTOR, "div:nth-child(2) > div > span").text
+                        found_album = element.find_element(By.CSS_SELECTOR, "div:nth-child(3) > span > a").text
+                        matches = True
+
+                if matches:
+                    button = element.find_element(By.CSS_SELECTOR, "div:nth-child(4) > button:nth-child(3)")
+                    button.click()
+                    ctx: WebElement = WebDriverWait(driver, 10).until(expected_conditions.presence_of_element_located((By.ID, "context-menu")))
+                    #first_el = ctx.find_element(By.CSS_SELECTOR, "li:first-child > button")
+                    share_el = ctx.find_element(By.CSS_SELECTOR, "li:nth-child(7) > button")
+                    webdriver.ActionChains(driver).move_to_element(share_el).perform()
+                    copy_link: WebElement = WebDriverWait(driver, 10).until(expected_conditions.presence_of_element_located((By.CSS_SELECTOR, "#context-menu li:nth-child(7) > div > ul > :first-child > button")))
+                    copy_link.click()
+
+                    search_bar = driver.find_element(By.XPATH, "//*[@id=\"main\"]/div/div[2]/div[1]/header/div[3]/div/div/form/input")
+                    webdriver.ActionChains(driver).move_to_element(search_bar).click().key_down(Keys.CONTROL).send_keys("av").key_up(Keys.CONTROL).perform()
+
+                    spotify_uri = search_bar.get_attribute("value").split("?")[0][31:]
+
+                    scraped[key] = (found_album, spotify_uri)
+                    store_matches(db, { key: scraped[key] })
+                else:
+                    for name in variants[key]:
+                        skipped.append(no_extra[name])
+
                 j += 1
-                continue
-            
-            found_name = element.find_element(By.CSS_SELECTOR, "div:nth-child(2) > div > div").text
-            found_artist = element.find_element(By.CSS_SELECTOR, "div:nth-child(2) > div > span").text
-            found_album = element.find_element(By.CSS_SELECTOR, "div:nth-child(3) > span > a").text
-
-            matches = found_name == k[0] and found_artist == k[1]
-
-            if not matches:
-                print(f"Expected: {k[1]} - {k[0]}")
-                print(f"Got:      {found_artist} - {found_name}")
-                res = input("Correct? (y/n/index) ")
-
-                if res == "y" or res == "Y":
-                    matches = True
-                elif res != "n" and res != "N":
-                    index = int(res)
-                    element = driver.find_element(By.XPATH, f"//*[@id=\"searchPage\"]/div/div/div/div[1]/div[2]/div[2]/div[{index}]/div")
-                    found_name = element.find_element(By.CSS_SELECTOR, "div:nth-child(2) > div > div").text
-                    found_artist = element.find_element(By.CSS_SELECTOR, "div:nth-child(2) > div > span").text
-                    found_album = element.find_element(By.CSS_SELECTOR, "div:nth-child(3) > span > a").text
-                    matches = True
-
-            if matches:
-                button = element.find_element(By.CSS_SELECTOR, "div:nth-child(4) > button:nth-child(3)")
-                button.click()
-                ctx: WebElement = WebDriverWait(driver, 10).until(expected_conditions.presence_of_element_located((By.ID, "context-menu")))
-                #first_el = ctx.find_element(By.CSS_SELECTOR, "li:first-child > button")
-                share_el = ctx.find_element(By.CSS_SELECTOR, "li:nth-child(7) > button")
-                webdriver.ActionChains(driver).move_to_element(share_el).perform()
-                copy_link: WebElement = WebDriverWait(driver, 10).until(expected_conditions.presence_of_element_located((By.CSS_SELECTOR, "#context-menu li:nth-child(7) > div > ul > :first-child > button")))
-                copy_link.click()
-
-                search_bar = driver.find_element(By.XPATH, "//*[@id=\"main\"]/div/div[2]/div[1]/header/div[3]/div/div/form/input")
-                webdriver.ActionChains(driver).move_to_element(search_bar).click().key_down(Keys.CONTROL).send_keys("av").key_up(Keys.CONTROL).perform()
-                
-                spotify_uri = search_bar.get_attribute("value").split("?")[0][31:]
-
-                db.execute("UPDATE endsong_modified SET master_metadata_album_album_name = ?, spotify_track_uri = ? WHERE master_metadata_track_name = ? AND master_metadata_album_artist_name = ?", (found_album, spotify_uri, k[0], k[1]))
-            else:
-                skipped[v] = v
 
-            j += 1
-            
-        driver.quit()
+            driver.quit()
+
+        db.executemany("UPDATE endsong_modified SET master_metadata_album_album_name = ?, spotify_track_uri = ? WHERE master_metadata_track_name = ? AND master_metadata_album_artist_name = ?", [
+            (*scraped[key], track_name, artist_name)
+            for key, names in variants.items() if key in scraped
+            for track_name, artist_name in names
+        ])
 
-    # I messed up formatting twice :)
-    print("Fixing up Spotify URIs")
-    count = db.execute("SELECT COUNT(id) FROM endsong_modified WHERE spotify_track_uri LIKE 'https%'").fetchone()[0]
-    for idnum, uri in tqdm(db.execute("SELECT id, spotify_track_uri FROM endsong_modified WHERE spotify_track_uri LIKE 'https%'"), total=count):
-        fixed = "spotify:track:" + uri.split("?")[0][31:]
-        db.execute("UPDATE endsong_modified SET spotify_track_uri = ? WHERE id = ?", (fixed, idnum))
+        # I messed up formatting twice :)
+        print("Fixing up Spotify URIs")
+        # Either a full https://open.spotify.com/track/ link or just the ID
+        db.execute("""
+        UPDATE endsong_modified
+        SET spotify_track_uri = 'spotify:track:' || CASE
+            WHEN spotify_track_uri LIKE 'https%' THEN substr(spotify_track_uri, 32, instr(spotify_track_uri || '?', '?') - 32)
+            ELSE spotify_track_uri
+        END
+        WHERE spotify_track_uri NOT LIKE 'spotify%'
+        """)
 
-    print("Fixing up Spotify URIs (2)")
-    count = db.execute("SELECT COUNT(id) FROM endsong_modified WHERE spotify_track_uri NOT LIKE 'spotify%'").fetchone()[0]
-    for idnum, uri in tqdm(db.execute("SELECT id, spotify_track_uri FROM endsong_modified WHERE spotify_track_uri NOT LIKE 'spotify%'"), total=count):
-        fixed = f"spotify:track:{uri}"
-        db.execute("UPDATE endsong_modified SET spotify_track_uri = ? WHERE id = ?", (fixed, idnum))
+        print("Deleting \"Unknown Track\" entries")
+        db.execute("DELETE FROM endsong_modified WHERE master_metadata_track_name = 'Unknown Track' AND master_metadata_album_artist_name = 'Unknown Artist'")
 
-    print("Deleting \"Unknown Track\" entries")
-    db.execute("DELETE FROM endsong_modified WHERE master_metadata_track_name = 'Unknown Track' AND master_metadata_album_artist_name = 'Unknown Artist'")
+        print("Saving modified data")
+        cursor = db.execute("SELECT * FROM endsong_modified")
+        # Everything except our own source and id columns
+        export = [ (j, column[0]) for j, column in enumerate(cursor.description) if column[0] not in ("source", "id") ]
 
-    print("Saving modified data")
-    db.row_factory = sqlite3.Row
-    result = []
-    for row in db.execute("SELECT * FROM endsong_modified"):
-        row_dict = dict(row)
-        del row_dict["source"]
-        del row_dict["id"]
-        result.append(row_dict)
+        outfile = outdir / "endsong_00.json"
 
-    outfile = outdir / "endsong_00.json"
+        # Written row by row, so the result never has to be in memory all at once
+        with outfile.open("wb") as f:
+            f.write(b"[")
+            for j, row in enumerate(cursor):
+                if j > 0:
+                    f.write(b",")
 
-    with outfile.open("w") as f:
-        json.dump(result, f)
+                f.write(orjson.dumps({ name: row[k] for k, name in export }))
 
-    print(f"Updated: {i}")
+            f.write(b"]")
 
-    if len(missing) > 0:
-        print("Missing:")
-        print(json.dumps(list(missing), indent=2))
+        print(f"Updated: {i}")
 
-    if len(unsure) > 0:
-        print("Unsure:")
-        print(json.dumps(list(unsure), indent=2))
+        if len(missing) > 0:
+            print("Missing:")
+            print(json.dumps(list(missing), indent=2))
 
-    if len(skipped) > 0:
-        print("No extra data:")
-        print(json.dumps(list(skipped), indent=2, ensure_ascii=False))
+        if len(unsure) > 0:
+            print("Unsure:")
+            print(json.dumps(list(unsure), indent=2))
 
-db.backup(db_source)
+        if len(skipped) > 0:
+            print("No extra data:")
+            print(json.dumps(list(skipped), indent=2, ensure_ascii=False))
 
-db_source.close()
-db.close()
+    db.close()